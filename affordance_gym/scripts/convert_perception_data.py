@@ -0,0 +1,73 @@
+import os
+import pickle
+import argparse
+import numpy as np
+
+from affordance_gym.utils import parse_vaed_arguments
+
+from env_setup.env_setup import VAED_MODELS_PATH, LOOK_AT
+
+
+'''
+
+Converts pickled policy training data (older outputs of generate_perception_data.py) to the .npz format read by perception_policy_train.py.
+
+Each .pkl file in the perception model's mujoco_latents folder is written next to it as a .npz file with the same name.
+
+ROS is not needed.
+
+'''
+
+
+def load_pickle(file_path):
+
+    with open(file_path, 'rb') as f:
+        # Older datasets were pickled with Python 2
+        dataset = pickle.load(f, encoding='latin1')
+
+    if len(dataset) < 7:
+        # Datasets without lookats
+        latents, camera_distances, azimuths, elevations, cup_ids, cup_positions = dataset
+        lookats = np.zeros([latents.shape[0], len(LOOK_AT)])
+        lookats[:, :] = LOOK_AT
+    else:
+        latents, lookats, camera_distances, azimuths, elevations, cup_ids, cup_positions = dataset
+
+    # Only the first latent of each sample is used in training
+    return dict(latents=np.ascontiguousarray(latents[:, 0, :]), lookats=lookats, camera_distances=camera_distances, azimuths=azimuths,
+                elevations=elevations, cup_ids=cup_ids, cup_positions=cup_positions)
+
+
+def main(args):
+
+    data_path = os.path.join(VAED_MODELS_PATH, args.vaed_name, 'mujoco_latents')
+
+    for file in sorted(os.listdir(data_path)):
+
+        name, extension = os.path.splitext(file)
+
+        if extension != '.pkl':
+            continue
+
+        save_to = os.path.join(data_path, name + '.npz')
+
+        if os.path.exists(save_to) and not args.overwrite:
+            print("Skipping {}, {} already exists".format(file, save_to))
+            continue
+
+        print("Converting: ", file)
+        np.savez(save_to, **load_pickle(os.path.join(data_path, file)))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert pickled policy training data of a vaed to the npz format')
+
+    parse_vaed_arguments(parser)
+
+    parser.add_argument('--overwrite', dest='overwrite', action='store_true', help='Overwrites existing npz files')
+    parser.set_defaults(overwrite=False)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -3,7 +3,6 @@ import numpy as np
 import rospy
 import matplotlib.pyplot as plt
 from PIL import Image
-import pickle
 import argparse
 
 from affordance_gym.utils import parse_vaed_arguments
@@ -310,14 +309,13 @@ if __name__  == '__main__':
         os.makedirs(save_path)
 
     if args.clutter_env:
-        save_path = os.path.join(save_path, 'random_{}.pkl'.format(args.cup_id))
+        save_path = os.path.join(save_path, 'random_{}.npz'.format(args.cup_id))
     elif args.two_cups:
-        save_path = os.path.join(save_path, 'two_cups_latents_{}.pkl'.format(args.cup_id))
+        save_path = os.path.join(save_path, 'two_cups_latents_{}.npz'.format(args.cup_id))
     else:
-        save_path = os.path.join(save_path, 'latents_{}.pkl'.format(args.cup_id))
+        save_path = os.path.join(save_path, 'latents_{}.npz'.format(args.cup_id))
 
-    f = open(save_path, 'wb')
-    pickle.dump([np.array(latents), np.array(lookat_points), np.array(container_distances),
-                 np.array(container_azimuths), np.array(container_elevations),
-                 np.array(cup_ids), np.array(cup_positions)], f)
-    f.close()
+    # Latents are stored without the batch dimension of get_latent
+    np.savez(save_path, latents=np.array(latents)[:, 0, :], lookats=np.array(lookat_points),
+             camera_distances=np.array(container_distances), azimuths=np.array(container_azimuths),
+             elevations=np.array(container_elevations), cup_ids=np.array(cup_ids), cup_positions=np.array(cup_positions))
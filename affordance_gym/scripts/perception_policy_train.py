@@ -1,7 +1,7 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torch.optim as optim
-from torch.autograd import Variable
 from torch.utils import data
 from torch.nn import functional as F
 import numpy as np
@@ -34,10 +34,15 @@ The forward kinematics solver is included to the PyTorch computation graph.
 def load_dataset(perception_name, fixed_camera, debug):
 
     data_path = os.path.join(VAED_MODELS_PATH, perception_name, 'mujoco_latents')
-    data_files = os.listdir(data_path)
+    # Pickled datasets can be converted with convert_perception_data.py
+    data_files = sorted(file for file in os.listdir(data_path) if file.endswith('.npz'))
+
+    if len(data_files) == 0:
+        raise FileNotFoundError("No .npz datasets in {}. Pickled datasets have to be converted first with "
+                                "scripts/convert_perception_data.py".format(data_path))
 
     if debug:
-        data_files = [data_files[0], data_files[-2]]
+        data_files = data_files[:2]
 
     print("Loading: ", data_files)
     # Multiple data packages exist
@@ -53,27 +58,13 @@ def load_dataset(perception_name, fixed_camera, debug):
         print(file)
         dataset = np.load(os.path.join(data_path, file))
 
-        if len(dataset) < 7:
-            # Datasets without lookats (This part can be removed in the future)
-            latents.append(dataset[0][:, 0, :])
-            lookat_values = np.zeros([dataset[0].shape[0], 2])
-            lookat_values[:, :] = LOOK_AT[:2]
-
-            lookats.append(lookat_values)
-            camera_distances.append(dataset[1])
-            azimuths.append(dataset[2])
-            elevations.append(dataset[3])
-            cup_ids.append(dataset[4])
-            target_coords.append(dataset[5])
-        else:
-
-            latents.append(dataset[0][:, 0, :]) # Bug fix
-            lookats.append(dataset[1][:, :2])
-            camera_distances.append(dataset[2])
-            azimuths.append(dataset[3])
-            elevations.append(dataset[4])
-            cup_ids.append(dataset[5])
-            target_coords.append(dataset[6])
+        latents.append(dataset['latents'])
+        lookats.append(dataset['lookats'][:, :2])
+        camera_distances.append(dataset['camera_distances'])
+        azimuths.append(dataset['azimuths'])
+        elevations.append(dataset['elevations'])
+        cup_ids.append(dataset['cup_ids'])
+        target_coords.append(dataset['cup_positions'])
 
     # Arrays to numpy
     latents = np.concatenate(latents)
@@ -111,16 +102,64 @@ def load_dataset(perception_name, fixed_camera, debug):
     print(inputs.shape)
 
     if debug:
-        indices = np.random.random_integers(0, inputs.shape[0], 100)
+        indices = np.random.default_rng().integers(0, inputs.shape[0], 100)
         inputs = inputs[indices]
         target_coords = target_coords[indices]
 
-    # To tensor
-    inputs = torch.Tensor(inputs)
-    target_coord = torch.Tensor(target_coords)
+    # To tensor (shares memory with the arrays when they already are contiguous fp32)
+    inputs = torch.from_numpy(np.ascontiguousarray(inputs)).float()
+    target_coord = torch.from_numpy(np.ascontiguousarray(target_coords)).float()
     return data.TensorDataset(inputs, target_coord)
 
 
+def iterate_batches(inputs, targets, batch_size, shuffle=False):
+
+    # Slices mini-batches from tensors that already live on the device
+    num_samples = inputs.shape[0]
+
+    if shuffle:
+        order = torch.randperm(num_samples, device=inputs.device)
+    else:
+        order = torch.arange(num_samples, device=inputs.device)
+
+    for i in range(0, num_samples, batch_size):
+        indices = order[i:i + batch_size]
+        yield inputs[indices], targets[indices]
+
+
+def trace_decoder(decoder, batch_size, latent_size, check_sizes, use_amp, device):
+
+    # Traces the decoder and checks the traced graph against the eager decoder for other batch sizes,
+    # with the fp16 inputs it gets from the policy under autocast. The first check runs with gradients
+    # enabled and also compares the input gradients, as in training.
+    traced = torch.jit.trace(decoder, torch.zeros(batch_size, latent_size, device=device))
+
+    dtype = torch.float16 if use_amp else torch.float32
+    tolerance = 1e-2 if use_amp else 1e-4
+
+    for idx, size in enumerate(check_sizes):
+
+        with_grad = idx == 0
+        latent = torch.randn(size, latent_size, device=device, dtype=dtype, requires_grad=with_grad)
+
+        results = []
+        for model in (traced, decoder):
+            with torch.set_grad_enabled(with_grad), torch.cuda.amp.autocast(enabled=use_amp):
+                output = model(latent)
+
+            result = [output.detach().float()]
+            if with_grad:
+                grad, = torch.autograd.grad(output.float().sum(), latent)
+                result.append(grad.float())
+            results.append(result)
+
+        for traced_result, eager_result in zip(*results):
+            if traced_result.shape != eager_result.shape or not torch.allclose(traced_result, eager_result, rtol=tolerance, atol=tolerance):
+                raise RuntimeError("The traced trajectory decoder does not match the eager decoder for batch size {}".format(size))
+
+    return traced
+
+
 def main(args):
 
     save_path = os.path.join(POLICY_MODELS_PATH, args.policy_name)
@@ -138,6 +177,9 @@ def main(args):
     traj_decoder.eval()
     traj_decoder.to(device)
 
+    # The decoder is not trained, gradients are only needed w.r.t. its input
+    traj_decoder.requires_grad_(False)
+
     # Load data
     dataset = load_dataset(args.vaed_name, args.fixed_camera, args.debug)
 
@@ -149,115 +191,143 @@ def main(args):
 
     policy.to(device)
 
-    optimizer = optim.Adam(policy.parameters(), lr=args.lr)
-    optimizer.zero_grad()
+    # Multi-tensor Adam updates all policy parameters with a few kernels
+    optimizer = optim.Adam(policy.parameters(), lr=args.lr, foreach=True)
+    optimizer.zero_grad(set_to_none=True)
+
+    # Mixed precision for the policy and the decoder (the forward kinematics stays in fp32)
+    use_amp = device.type == 'cuda'
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
 
     print("Dataset size", dataset.__len__())
     train_size = int(dataset.__len__() * 0.7)
-    test_size = dataset.__len__() - train_size
 
-    trainset, testset = data.random_split(dataset, (train_size, test_size))
+    # The whole dataset fits in memory, so it is moved to the device once.
+    # With mixed precision the inputs are stored in fp16, the targets stay in fp32 for the mse loss
+    inputs, targets = dataset.tensors
+    inputs = inputs.to(device, dtype=torch.float16 if use_amp else torch.float32)
+    targets = targets.to(device)
+
+    indices = torch.randperm(dataset.__len__(), device=device)
+    train_set_inputs, train_set_targets = inputs[indices[:train_size]], targets[indices[:train_size]]
+    test_set_inputs, test_set_targets = inputs[indices[train_size:]], targets[indices[train_size:]]
 
-    train_loader = data.DataLoader(trainset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_processes)
-    test_loader = data.DataLoader(testset, batch_size=10000)
+    # The last train and validation batches are smaller than the traced one
+    check_sizes = [1, train_size % args.batch_size, (dataset.__len__() - train_size) % args.batch_size]
+    traj_decoder = trace_decoder(traj_decoder, args.batch_size, args.traj_latent, [size for size in check_sizes if size > 0], use_amp, device)
+
+    # Affine constants for unnormalizing joint angles
+    joint_scale = torch.tensor(MAX_ANGLE - MIN_ANGLE, dtype=torch.float32, device=device)
+    joint_bias = torch.tensor(MIN_ANGLE, dtype=torch.float32, device=device)
 
     best_val = np.inf
 
     avg_train_losses = []
     avg_val_losses = []
 
+    # Figures are rendered in a background thread so that training does not wait for them
+    plot_executor = ThreadPoolExecutor(max_workers=1)
+    plot_jobs = []
+
 
     for epoch in range(args.num_epoch):
 
         print("Epoch {}".format(epoch + 1))
 
+        # plot_every < 1 plots only the last epoch
+        plot = epoch + 1 == args.num_epoch or (args.plot_every > 0 and (epoch + 1) % args.plot_every == 0)
+
         policy.train()
         # Training
-        train_losses = []
+        train_loss = torch.zeros((), device=device)
+        num_batches = 0
         end_poses = []
         target_poses = []
         latents = []
 
-        for input, target_pose in train_loader:
+        for latent_1, target_pose in iterate_batches(train_set_inputs, train_set_targets, args.batch_size, shuffle=True):
 
             # latent1 -> latent2
-            latent_1, target_pose = input.to(device), target_pose.to(device)
+            with torch.cuda.amp.autocast(enabled=use_amp):
 
-            latent_2 = policy(Variable(latent_1))
+                latent_2 = policy(latent_1)
 
-            # latent2 -> trajectory
-            trajectories = traj_decoder(latent_2)
+                # latent2 -> trajectory
+                trajectories = traj_decoder(latent_2)
 
-            # Reshape to trajectories
-            trajectories = action_vae.model.to_trajectory(trajectories)
+                # Reshape to trajectories
+                trajectories = action_vae.model.to_trajectory(trajectories)
 
-            # Get the last joint pose
-            end_joint_pose = trajectories[:, :, -1]
-            # Unnormalize
-            end_joint_pose = (MAX_ANGLE - MIN_ANGLE) * end_joint_pose + MIN_ANGLE
+            # Get the last joint pose and unnormalize it in a single kernel
+            end_joint_pose = torch.addcmul(joint_bias, trajectories[:, :, -1].float(), joint_scale)
 
             # joint pose -> cartesian
             end_pose = end_effector_pose(end_joint_pose, device)
 
             loss = F.mse_loss(end_pose, target_pose)
 
-            loss.backward()
-            optimizer.step()
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+            train_loss += loss.detach()
+            num_batches += 1
 
-            train_losses.append(loss.item())
-            end_poses.append(end_pose.detach().cpu().numpy())
-            target_poses.append(target_pose.cpu().numpy())
-            latents.append(latent_2.detach().cpu().numpy())
+            if plot:
+                end_poses.append(end_pose.detach())
+                target_poses.append(target_pose)
+                latents.append(latent_2.detach())
 
-        avg_loss = np.mean(train_losses)
+        # A single device sync per epoch
+        avg_loss = (train_loss / num_batches).item()
         avg_train_losses.append(avg_loss)
         print("Average error distance (training) {}".format(np.sqrt(avg_loss)))
 
-        train_poses = np.concatenate(end_poses)
-        train_targets = np.concatenate(target_poses)
+        if plot:
+            train_poses = torch.cat(end_poses).cpu().numpy()
+            train_targets = torch.cat(target_poses).cpu().numpy()
 
         # Validation
 
         policy.eval()
-        val_losses = []
+        val_loss = torch.zeros((), device=device)
+        num_batches = 0
         end_poses = []
         target_poses = []
 
-        for latent_1, target_pose in test_loader:
+        with torch.inference_mode():
 
-            # latent1 -> latent2
-            latent_1, target_pose = latent_1.to(device), target_pose.to(device)
-            latent_2 = policy(Variable(latent_1))
+            for latent_1, target_pose in iterate_batches(test_set_inputs, test_set_targets, args.batch_size):
 
-            # latent2 -> trajectory
-            trajectories = traj_decoder(latent_2)
+                # latent1 -> latent2
+                with torch.cuda.amp.autocast(enabled=use_amp):
 
-            # Reshape to trajectories
-            trajectories = action_vae.model.to_trajectory(trajectories)
+                    latent_2 = policy(latent_1)
 
-            # Get the last joint pose
-            end_joint_pose = trajectories[:, :, -1]
+                    # latent2 -> trajectory
+                    trajectories = traj_decoder(latent_2)
 
-            # Unnormalize
-            end_joint_pose = (MAX_ANGLE - MIN_ANGLE) * end_joint_pose + MIN_ANGLE
+                    # Reshape to trajectories
+                    trajectories = action_vae.model.to_trajectory(trajectories)
 
-            # joint pose -> cartesian
-            end_pose = end_effector_pose(end_joint_pose, device)
+                # Get the last joint pose and unnormalize it in a single kernel
+                end_joint_pose = torch.addcmul(joint_bias, trajectories[:, :, -1].float(), joint_scale)
 
-            loss = F.mse_loss(end_pose, target_pose)
+                # joint pose -> cartesian
+                end_pose = end_effector_pose(end_joint_pose, device)
 
-            end_poses.append(end_pose.detach().cpu().numpy())
+                loss = F.mse_loss(end_pose, target_pose)
 
-            val_losses.append(loss.item())
-            end_poses.append(end_pose.detach().cpu().numpy())
-            target_poses.append(target_pose.cpu().numpy())
-            latents.append(latent_2.detach().cpu().numpy())
+                val_loss += loss.detach()
+                num_batches += 1
 
-        avg_loss = np.mean(val_losses)
-        val_poses = np.concatenate(end_poses)
-        val_targets = np.concatenate(target_poses)
-        latents = np.concatenate(latents)
+                if plot:
+                    end_poses.append(end_pose.detach())
+                    target_poses.append(target_pose)
+                    latents.append(latent_2.detach())
+
+        avg_loss = (val_loss / num_batches).item()
 
         avg_val_losses.append(avg_loss)
         print("Average error distance (validation) {}".format(np.sqrt(avg_loss)))
@@ -266,15 +336,27 @@ def main(args):
             best_val = avg_loss
             torch.save(policy.state_dict(), os.path.join(save_path, '{}_model.pth.tar'.format(epoch)))
 
-        plot_scatter(train_poses, train_targets, os.path.join(save_path, 'train_scatter.png'))
-        plot_scatter(val_poses, val_targets, os.path.join(save_path, 'val_scatter.png'))
-        poses = np.concatenate([train_poses, val_poses])
-        targets = np.concatenate([train_targets, val_targets])
-        plot_scatter(poses, targets, os.path.join(save_path, 'full_scatter.png'))
-        plot_latent_distributions(latents, os.path.join(save_path, 'latents_distribution.png'))
+        if plot:
+
+            val_poses = torch.cat(end_poses).cpu().numpy()
+            val_targets = torch.cat(target_poses).cpu().numpy()
+            latents = torch.cat(latents).float().cpu().numpy()
+
+            # Wait for the previous figures (and raise their errors) before queueing new ones
+            for job in plot_jobs:
+                job.result()
+
+            plot_jobs = [
+                plot_executor.submit(plot_scatter, {'train': (train_poses, train_targets), 'validation': (val_poses, val_targets)},
+                                     os.path.join(save_path, 'scatter.png')),
+                plot_executor.submit(plot_latent_distributions, latents, os.path.join(save_path, 'latents_distribution.png')),
+                plot_executor.submit(plot_loss, list(avg_train_losses), list(avg_val_losses), 'Avg mse', os.path.join(save_path, 'avg_mse.png')),
+                plot_executor.submit(plot_loss, np.log(avg_train_losses), np.log(avg_val_losses), 'Avg mse in log scale', os.path.join(save_path, 'avg_log_mse.png'))
+            ]
 
-        plot_loss(avg_train_losses, avg_val_losses, 'Avg mse', os.path.join(save_path, 'avg_mse.png'))
-        plot_loss(np.log(avg_train_losses), np.log(avg_val_losses), 'Avg mse in log scale', os.path.join(save_path, 'avg_log_mse.png'))
+    for job in plot_jobs:
+        job.result()
+    plot_executor.shutdown()
 
 
 if __name__ == '__main__':
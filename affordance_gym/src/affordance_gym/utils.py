@@ -62,7 +62,8 @@ def parse_policy_train_arguments(parser):
     parser.add_argument('--num-epoch', default=1000, type=int)
     parser.add_argument('--batch-size', default=124, type=int)
     parser.add_argument('--lr', default=1.e-3, type=float, help='learning rate')
-    parser.add_argument('--num-processes', default=16, type=int)
+    parser.add_argument('--num-processes', default=16, type=int, help='Ignored, kept for old command lines (the policy dataset is kept on the device)')
+    parser.add_argument('--plot-every', default=10, type=int, help='Plots the training results every nth epoch (0 plots only the last epoch)')
 
 
 def sample_visualize(image, affordance_arr, sample_path, id):
@@ -129,13 +130,29 @@ def plot_loss(train, val, title, save_to):
     plt.close()
 
 
-def plot_scatter(constructed, targets, save_to):
-    fig = plt.figure()
-    plt.scatter(targets[:, 0], targets[:, 1], label='targets', c='r')
-    plt.scatter(constructed[:, 0], constructed[:, 1], label='constructed', c='b')
-    plt.legend()
+def plot_scatter(samples, save_to):
+
+    # samples: {name: (constructed, targets)}, each set gets its own subplot and the last subplot shows all of them
+    fig, axes = plt.subplots(1, len(samples) + 1, sharex=True, sharey=True, figsize=[6 * (len(samples) + 1), 5])
+    full_ax = axes[-1]
+
+    for ax, (name, (constructed, targets)) in zip(axes, samples.items()):
+        ax.scatter(targets[:, 0], targets[:, 1], label='targets', c='r')
+        ax.scatter(constructed[:, 0], constructed[:, 1], label='constructed', c='b')
+        ax.set_title(name)
+        ax.legend()
+
+    # All targets first so that the constructed points are drawn on top of them
+    for constructed, targets in samples.values():
+        full_ax.scatter(targets[:, 0], targets[:, 1], c='r')
+    for constructed, targets in samples.values():
+        full_ax.scatter(constructed[:, 0], constructed[:, 1], c='b')
+
+    full_ax.set_title('full')
+    full_ax.legend(*axes[0].get_legend_handles_labels())
+
     plt.savefig(save_to)
-    plt.close()
+    plt.close(fig)
 
 def plot_latent_distributions(latents, save_to):
 